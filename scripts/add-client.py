@@ -3,35 +3,165 @@
 import sys
 import os
 import subprocess
-import re
 import fcntl
+import base64
+import socket
+import shutil
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PrivateFormat, PublicFormat, NoEncryption
+)
+
+# amneziawg-go listens for configuration requests on <dir>/<interface>.sock
+UAPI_SOCKET_DIR = "/var/run/amneziawg"
+
+# Paths are relative to WORKDIR inside container
+CONFIG_DIR = "/etc/amnezia/amneziawg/config"
+
+# Obfuscation parameters used when server config does not set them
+OBF_DEFAULTS = {
+    'Jc': '4', 'Jmin': '50', 'Jmax': '1000',
+    'S1': '0', 'S2': '0', 'S3': '0', 'S4': '0',
+    'H1': '1', 'H2': '2', 'H3': '3', 'H4': '4',
+    'I1': '0', 'I2': '0', 'I3': '0', 'I4': '0', 'I5': '0'
+}
+
+# Client config (AmneziaWG format), filled in with str.format()
+CLIENT_TEMPLATE = """[Interface]
+PrivateKey = {private_key}
+Address = {client_ip}/32
+DNS = {dns}
+MTU = 1280
+Jc = {Jc}
+Jmin = {Jmin}
+Jmax = {Jmax}
+S1 = {S1}
+S2 = {S2}
+S3 = {S3}
+S4 = {S4}
+H1 = {H1}
+H2 = {H2}
+H3 = {H3}
+H4 = {H4}
 
-def run_cmd_with_input(cmd, stdin_data=None):
-    """Execute command with optional stdin, return stdout stripped"""
-    result = subprocess.run(
-        cmd,
-        input=stdin_data,
-        capture_output=True,
-        text=True
-    )
-    if result.returncode != 0:
-        print(f"ERROR: Command failed: {' '.join(cmd)}")
-        print(result.stderr)
-        sys.exit(1)
-    return result.stdout.strip()
+[Peer]
+PublicKey = {server_public}
+PresharedKey = {preshared}
+Endpoint = {server_ip}:{listen_port}
+AllowedIPs = 0.0.0.0/0, ::/0
+PersistentKeepalive = 25
+"""
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: add-client.py <client-name>")
+def parse_server_conf(server_conf):
+    """Extract VPN network, private key, last peer IP and obfuscation params in one pass"""
+    vpn_network = None
+    private_key = None
+    last_ip = 1
+    obf_params = {}
+
+    for line in server_conf.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#[':
+            continue
+        key, _, value = line.partition('=')
+        key = key.strip()
+        # Drop trailing "# comment" text
+        value = value.partition('#')[0].strip()
+
+        if key == 'AllowedIPs':
+            # Track highest peer host number in the VPN network ("10.201.0.5/32" -> 5);
+            # Address sits in [Interface], so vpn_network is known before any peer
+            if vpn_network:
+                for ip in value.split(','):
+                    ip = ip.strip()
+                    if ip.endswith('/32'):
+                        network, _, host = ip[:-3].rpartition('.')
+                        if network == vpn_network and host.isdigit():
+                            last_ip = max(last_ip, int(host))
+        elif key in OBF_DEFAULTS:
+            # First occurrence wins, like the original per-key re.search
+            if value.isdigit():
+                obf_params.setdefault(key, value)
+        elif key == 'Address' and vpn_network is None:
+            # e.g. "fd00::1/64, 10.201.0.1/24" -> "10.201.0"
+            for entry in value.split(','):
+                address, _, mask = entry.strip().partition('/')
+                octets = address.split('.')
+                if len(octets) == 4 and all(o.isdigit() for o in octets) and mask.isdigit():
+                    vpn_network = '.'.join(octets[:3])
+                    break
+        elif key == 'PrivateKey' and private_key is None:
+            private_key = value
+
+    return vpn_network, private_key, last_ip, obf_params
+
+def generate_private_key():
+    """Generate a base64-encoded Curve25519 private key (same as `awg genkey`)"""
+    private = X25519PrivateKey.generate()
+    raw = private.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+    return base64.b64encode(raw).decode()
+
+def derive_public_key(private_key):
+    """Derive base64-encoded public key from a base64 private key (same as `awg pubkey`)"""
+    try:
+        private = X25519PrivateKey.from_private_bytes(base64.b64decode(private_key))
+    except ValueError as e:
+        print(f"ERROR: Invalid private key: {e}")
         sys.exit(1)
+    raw = private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return base64.b64encode(raw).decode()
+
+def generate_preshared_key():
+    """Generate a base64-encoded 32-byte preshared key (same as `awg genpsk`)"""
+    return base64.b64encode(os.urandom(32)).decode()
+
+def write_secret(path, data):
+    """Write file created with 0600 permissions (no window where it is world-readable)"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+
+def add_peers_uapi(interface, peers):
+    """Add peers to running interface via the UAPI socket, return True on success
+
+    peers is a list of (public_key, preshared_key, allowed_ip) tuples.
+    """
+    socket_path = f"{UAPI_SOCKET_DIR}/{interface}.sock"
+    if not os.path.exists(socket_path):
+        return False
+
+    # UAPI expects keys as hex; request is terminated by an empty line
+    request = ["set=1\n"]
+    for public_key, preshared_key, allowed_ip in peers:
+        request.append(f"public_key={base64.b64decode(public_key).hex()}\n")
+        request.append(f"preshared_key={base64.b64decode(preshared_key).hex()}\n")
+        request.append(f"allowed_ip={allowed_ip}\n")
+    request.append("\n")
+
+    response = b""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(socket_path)
+            sock.sendall("".join(request).encode())
+            while not response.endswith(b"\n\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+    except OSError as e:
+        print(f"WARNING: UAPI request to {socket_path} failed: {e}")
+        return False
+
+    return b"errno=0\n" in response
 
-    client_name = sys.argv[1]
-    # Paths are relative to WORKDIR inside container
-    config_dir = "/etc/amnezia/amneziawg/config"
+def add_clients(client_names):
+    """Create clients under a single lock, server.conf parse/append and interface update"""
+    config_dir = CONFIG_DIR
     server_config = f"{config_dir}/server.conf"
     server_keys = f"{config_dir}/server.keys"
     clients_dir = f"{config_dir}/clients"
-    client_dir = f"{clients_dir}/{client_name}"
 
     # Check if server is initialized
     if not os.path.exists(server_config):
@@ -39,206 +169,205 @@ def main():
         print("Please start the server first.")
         sys.exit(1)
 
-    # Check if client already exists
-    if os.path.exists(client_dir):
-        print(f"ERROR: Client '{client_name}' already exists!")
+    if len(set(client_names)) != len(client_names):
+        print("ERROR: Duplicate client names given!")
         sys.exit(1)
 
+    # Names become directory and file names under clients/
+    for client_name in client_names:
+        if client_name in ('', '.', '..') or '/' in client_name or '\n' in client_name:
+            print(f"ERROR: Invalid client name: {client_name!r}")
+            sys.exit(1)
+
+    # Check if any client already exists
+    for client_name in client_names:
+        if os.path.exists(f"{clients_dir}/{client_name}"):
+            print(f"ERROR: Client '{client_name}' already exists!")
+            sys.exit(1)
+
     # Lock file to prevent race conditions
     lock_file = f"{config_dir}/.add-client.lock"
-    # Ensure config dir exists
-    os.makedirs(config_dir, exist_ok=True)
-
-    lock_fd = open(lock_file, 'w')
+    # config_dir is known to exist (server_config was found above);
+    # open without O_TRUNC so the lock file is not rewritten on every run
+    lock_fd = os.fdopen(os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o600), 'r+')
     try:
         fcntl.flock(lock_fd, fcntl.LOCK_EX)
 
-        # Create client directory
-        os.makedirs(client_dir, mode=0o700, exist_ok=True)
-
         # Read server config
         with open(server_config, 'r') as f:
             server_conf = f.read()
 
-        # Extract VPN network from Address line (e.g., "10.201.0.1/24" -> "10.201.0")
-        address_match = re.search(r'Address\s*=\s*(\d+\.\d+\.\d+)\.\d+/\d+', server_conf)
-        if not address_match:
+        # Parse everything we need from server config in a single pass
+        vpn_network, server_private, last_ip, server_obf = parse_server_conf(server_conf)
+        if not vpn_network:
             print("ERROR: Cannot parse VPN network from server config")
             sys.exit(1)
 
-        vpn_network = address_match.group(1)
-
-        # Find next available IP
+        # Find next available IPs (consecutive after the last assigned one)
         print("Finding next available IP...")
-        existing_ips = re.findall(rf'AllowedIPs\s*=\s*{re.escape(vpn_network)}\.(\d+)/32', server_conf)
-        if existing_ips:
-            last_ip = max(int(ip) for ip in existing_ips)
-            client_ip_num = max(last_ip + 1, 2)
-        else:
-            client_ip_num = 2
-
-        client_ip = f"{vpn_network}.{client_ip_num}"
-        print(f"Assigned IP: {client_ip}")
-
-        # Generate keys using local awg command
-        print("Generating client keys...")
-
-        # Generate private key
-        client_private = run_cmd_with_input(['awg', 'genkey'])
-
-        # Generate public key from private (pass via stdin)
-        client_public = run_cmd_with_input(
-            ['awg', 'pubkey'],
-            stdin_data=client_private
-        )
-
-        # Generate preshared key
-        preshared = run_cmd_with_input(['awg', 'genpsk'])
-
-        # Validate key lengths
-        if len(client_private) != 44:
-            print(f"ERROR: Invalid private key length: {len(client_private)}")
+        first_ip_num = max(last_ip + 1, 2)
+        if first_ip_num + len(client_names) - 1 > 254:
+            print(f"ERROR: Not enough free addresses in {vpn_network}.0/24")
             sys.exit(1)
-        if len(client_public) != 44:
-            print(f"ERROR: Invalid public key length: {len(client_public)}")
-            sys.exit(1)
-        if len(preshared) != 44:
-            print(f"ERROR: Invalid preshared key length: {len(preshared)}")
-            sys.exit(1)
-
-        # Save keys
-        with open(f"{client_dir}/privatekey", 'w') as f:
-            f.write(client_private)
-        with open(f"{client_dir}/publickey", 'w') as f:
-            f.write(client_public)
-        with open(f"{client_dir}/presharedkey", 'w') as f:
-            f.write(preshared)
-
-        os.chmod(f"{client_dir}/privatekey", 0o600)
-        os.chmod(f"{client_dir}/publickey", 0o600)
-        os.chmod(f"{client_dir}/presharedkey", 0o600)
 
         # Get server public key
         server_public = ""
         if os.path.exists(server_keys):
             with open(server_keys, 'r') as f:
-                keys_content = f.read()
-            for line in keys_content.split('\n'):
-                if line.strip().startswith('PUBLIC_KEY='):
-                    server_public = line.split('=', 1)[1].strip()
-                    break
+                keys = dict(
+                    line.strip().split('=', 1) for line in f
+                    if '=' in line and not line.lstrip().startswith('#')
+                )
+            server_public = keys.get('PUBLIC_KEY', '').strip()
 
         if not server_public or len(server_public) != 44:
             # Fallback: derive from private key in config
-            private_match = re.search(r'PrivateKey\s*=\s*(\S+)', server_conf)
-            if not private_match:
+            if not server_private:
                 print("ERROR: Cannot find server private key")
                 sys.exit(1)
-            server_private = private_match.group(1).strip()
-            server_public = run_cmd_with_input(
-                ['awg', 'pubkey'],
-                stdin_data=server_private
-            )
+            server_public = derive_public_key(server_private)
 
         # Get server settings from environment (inside container)
         server_ip = os.getenv('SERVER_IP', 'YOUR_SERVER_IP')
         listen_port = os.getenv('LISTEN_PORT', '51820')
         dns = os.getenv('DNS', '1.1.1.1')
 
-        # Extract obfuscation parameters from server config
-        # Default to 0 if not found, but try to parse
-        obf_params = {
-            'Jc': '4', 'Jmin': '50', 'Jmax': '1000',
-            'S1': '0', 'S2': '0', 'S3': '0', 'S4': '0',
-            'H1': '1', 'H2': '2', 'H3': '3', 'H4': '4',
-            'I1': '0', 'I2': '0', 'I3': '0', 'I4': '0', 'I5': '0'
-        }
-
-        for param in obf_params.keys():
-            match = re.search(rf'^\s*{param}\s*=\s*(\d+)', server_conf, re.MULTILINE)
-            if match:
-                obf_params[param] = match.group(1)
-
-        # Create client config (AmneziaWG format)
-        client_config = f"""[Interface]
-PrivateKey = {client_private}
-Address = {client_ip}/32
-DNS = {dns}
-MTU = 1280
-Jc = {obf_params['Jc']}
-Jmin = {obf_params['Jmin']}
-Jmax = {obf_params['Jmax']}
-S1 = {obf_params['S1']}
-S2 = {obf_params['S2']}
-S3 = {obf_params['S3']}
-S4 = {obf_params['S4']}
-H1 = {obf_params['H1']}
-H2 = {obf_params['H2']}
-H3 = {obf_params['H3']}
-H4 = {obf_params['H4']}
+        # Obfuscation parameters from server config, defaults for missing ones
+        obf_params = {**OBF_DEFAULTS, **server_obf}
 
-[Peer]
-PublicKey = {server_public}
-PresharedKey = {preshared}
-Endpoint = {server_ip}:{listen_port}
-AllowedIPs = 0.0.0.0/0, ::/0
-PersistentKeepalive = 25
-"""
+        # Generate and validate everything in memory before touching the disk
+        clients = []
+        for client_ip_num, client_name in enumerate(client_names, first_ip_num):
+            client_ip = f"{vpn_network}.{client_ip_num}"
+            print(f"Assigned IP: {client_ip} ({client_name})")
+
+            # Generate keys in-process (no awg subprocesses needed)
+            print("Generating client keys...")
 
-        with open(f"{client_dir}/{client_name}.conf", 'w') as f:
-            f.write(client_config)
+            # Generate private key
+            client_private = generate_private_key()
 
-        os.chmod(f"{client_dir}/{client_name}.conf", 0o600)
+            # Derive public key from private
+            client_public = derive_public_key(client_private)
 
-        # Add peer to server config
-        peer_config = f"""
+            # Generate preshared key
+            preshared = generate_preshared_key()
+
+            # Validate key lengths
+            if len(client_private) != 44:
+                print(f"ERROR: Invalid private key length: {len(client_private)}")
+                sys.exit(1)
+            if len(client_public) != 44:
+                print(f"ERROR: Invalid public key length: {len(client_public)}")
+                sys.exit(1)
+            if len(preshared) != 44:
+                print(f"ERROR: Invalid preshared key length: {len(preshared)}")
+                sys.exit(1)
+
+            # Create client config (AmneziaWG format)
+            client_config = CLIENT_TEMPLATE.format(
+                private_key=client_private, client_ip=client_ip, dns=dns,
+                server_public=server_public, preshared=preshared,
+                server_ip=server_ip, listen_port=listen_port,
+                **obf_params
+            )
+
+            # Peer block for server config
+            peer_config = f"""
 [Peer]
 # Client: {client_name}
 PublicKey = {client_public}
 PresharedKey = {preshared}
 AllowedIPs = {client_ip}/32
 """
-        with open(server_config, 'a') as f:
-            f.write(peer_config)
+            clients.append({
+                'name': client_name,
+                'dir': f"{clients_dir}/{client_name}",
+                'ip': client_ip,
+                'private': client_private,
+                'public': client_public,
+                'preshared': preshared,
+                'config': client_config,
+                'peer_config': peer_config,
+            })
+
+        peer_configs = [client['peer_config'] for client in clients]
+        new_peers = [(client['public'], client['preshared'], f"{client['ip']}/32") for client in clients]
+        # Encoded once, reused for awg below
+        peer_bytes = "".join(peer_configs).encode()
+
+        # Save client files and server config; on failure remove what was
+        # created so a re-run is possible
+        created_dirs = []
+        try:
+            for client in clients:
+                client_dir = client['dir']
+
+                # Create client directory
+                os.makedirs(client_dir, mode=0o700)
+                created_dirs.append(client_dir)
+
+                # Save keys
+                write_secret(f"{client_dir}/privatekey", client['private'])
+                write_secret(f"{client_dir}/publickey", client['public'])
+                write_secret(f"{client_dir}/presharedkey", client['preshared'])
+
+                write_secret(f"{client_dir}/{client['name']}.conf", client['config'])
+
+            # Add all peers to server config at once
+            fd = os.open(server_config, os.O_WRONLY | os.O_APPEND)
+            try:
+                size = os.lseek(fd, 0, os.SEEK_END)
+                try:
+                    # os.write may write less than asked; loop until done
+                    remaining = memoryview(peer_bytes)
+                    while remaining:
+                        remaining = remaining[os.write(fd, remaining):]
+                except OSError:
+                    # Do not leave a partial [Peer] block behind
+                    os.ftruncate(fd, size)
+                    raise
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"ERROR: Failed to save clients: {e}")
+            for client_dir in created_dirs:
+                shutil.rmtree(client_dir, ignore_errors=True)
+            sys.exit(1)
 
         # Determine interface name (awg-quick uses config filename as interface name)
         # Config is at /etc/amnezia/amneziawg/config/server.conf, so interface is likely "server"
         # But we check INTERFACE env var too
-        env_interface = os.getenv('INTERFACE', 'awg0')
+        # docker-compose passes INTERFACE="" when it is unset in .env
+        env_interface = os.getenv('INTERFACE') or 'awg0'
 
-        # Check which interface is actually running
-        active_interface = "server" # Default fallback
-        try:
-            # Check if env_interface exists
-            check = subprocess.run(['ip', 'link', 'show', env_interface], capture_output=True)
-            if check.returncode == 0:
-                active_interface = env_interface
-            else:
-                # Check if "server" interface exists
-                check = subprocess.run(['ip', 'link', 'show', 'server'], capture_output=True)
-                if check.returncode == 0:
-                    active_interface = 'server'
-        except Exception:
-            pass
-
-        print(f"Adding peer to running interface ({active_interface})...")
-        # Create a temporary config file for the new peer only
-        temp_peer_config = f"/tmp/new_peer_{client_name}.conf"
-        with open(temp_peer_config, 'w') as f:
-            f.write(peer_config)
-
-        # Use addconf to append the new peer configuration
-        subprocess.run(['awg', 'addconf', active_interface, temp_peer_config], check=False)
-        os.remove(temp_peer_config)
-
-        print()
-        print(f"✓ Client '{client_name}' created successfully!")
-        print(f"  Config: {client_dir}/{client_name}.conf")
-        print(f"  IP: {client_ip}")
+        # Check which interface is actually running ("server" is the fallback)
+        if os.path.isdir(f"/sys/class/net/{env_interface}"):
+            active_interface = env_interface
+        else:
+            active_interface = "server"
+
+        print(f"Adding {len(new_peers)} peer(s) to running interface ({active_interface})...")
+        if not add_peers_uapi(active_interface, new_peers):
+            # Fallback: let awg apply the peers (e.g. kernel module instead of amneziawg-go)
+            subprocess.run(['awg', 'addconf', active_interface, '/dev/stdin'], input=peer_bytes, check=False)
+
+        for client in clients:
+            print()
+            print(f"✓ Client '{client['name']}' created successfully!")
+            print(f"  Config: {client['dir']}/{client['name']}.conf")
+            print(f"  IP: {client['ip']}")
 
     finally:
         fcntl.flock(lock_fd, fcntl.LOCK_UN)
         lock_fd.close()
 
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: add-client.py <client-name> [<client-name> ...]")
+        sys.exit(1)
+
+    add_clients(sys.argv[1:])
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import base64
+import contextlib
+import importlib.util
+import io
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# add-client.py is not importable by name (hyphen), load it from its path
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'add-client.py')
+spec = importlib.util.spec_from_file_location('add_client', SCRIPT)
+add_client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(add_client)
+
+SERVER_CONF = """[Interface]
+PrivateKey = cGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGE=
+Address = 10.8.0.1/24
+Jc = 7
+"""
+
+class ParseServerConfTest(unittest.TestCase):
+    def test_basic(self):
+        conf = SERVER_CONF + """
+[Peer]
+# Client: alice
+AllowedIPs = 10.8.0.3/32
+"""
+        vpn_network, private_key, last_ip, obf = add_client.parse_server_conf(conf)
+        self.assertEqual(vpn_network, '10.8.0')
+        self.assertEqual(private_key, 'cGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGFkcGE=')
+        self.assertEqual(last_ip, 3)
+        self.assertEqual(obf, {'Jc': '7'})
+
+    def test_no_peers(self):
+        _, _, last_ip, _ = add_client.parse_server_conf(SERVER_CONF)
+        self.assertEqual(last_ip, 1)
+
+    def test_allowed_ips_trailing_comment(self):
+        conf = SERVER_CONF + """
+[Peer]
+AllowedIPs = 10.8.0.3/32
+[Peer]
+AllowedIPs = 10.8.0.9/32 # bob
+"""
+        _, _, last_ip, _ = add_client.parse_server_conf(conf)
+        self.assertEqual(last_ip, 9)
+
+    def test_allowed_ips_outside_network_ignored(self):
+        conf = SERVER_CONF + """
+[Peer]
+AllowedIPs = 10.8.0.4/32, fd00::4/128
+[Peer]
+AllowedIPs = 10.9.0.50/32
+[Peer]
+AllowedIPs = 10.8.0.60/24
+"""
+        _, _, last_ip, _ = add_client.parse_server_conf(conf)
+        self.assertEqual(last_ip, 4)
+
+    def test_obf_param_trailing_comment(self):
+        conf = SERVER_CONF.replace("Jc = 7", "Jc = 7  # tuned")
+        _, _, _, obf = add_client.parse_server_conf(conf)
+        self.assertEqual(obf['Jc'], '7')
+
+    def test_address_ipv6_first(self):
+        conf = SERVER_CONF.replace("Address = 10.8.0.1/24", "Address = fd00::1/64, 10.8.0.1/24")
+        vpn_network, _, _, _ = add_client.parse_server_conf(conf)
+        self.assertEqual(vpn_network, '10.8.0')
+
+    def test_duplicate_obf_param_first_wins(self):
+        conf = SERVER_CONF + "Jc = 9\n"
+        _, _, _, obf = add_client.parse_server_conf(conf)
+        self.assertEqual(obf['Jc'], '7')
+
+class KeyGenerationTest(unittest.TestCase):
+    # RFC 7748, section 6.1 (Alice's key pair)
+    RFC7748_PRIVATE = base64.b64encode(bytes.fromhex(
+        '77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a')).decode()
+    # 8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a
+    RFC7748_PUBLIC = 'hSDwCYkwp1R0i33ctD73Wg2/Og0mOBr066SpjqqbTmo='
+
+    def assert_wg_key(self, key):
+        self.assertEqual(len(key), 44)
+        self.assertEqual(len(base64.b64decode(key, validate=True)), 32)
+
+    def test_derive_public_key_known_answer(self):
+        self.assertEqual(add_client.derive_public_key(self.RFC7748_PRIVATE), self.RFC7748_PUBLIC)
+
+    def test_generated_keys_are_wg_format(self):
+        private = add_client.generate_private_key()
+        self.assert_wg_key(private)
+        self.assert_wg_key(add_client.derive_public_key(private))
+        self.assert_wg_key(add_client.generate_preshared_key())
+
+    def test_generated_keys_differ(self):
+        self.assertNotEqual(add_client.generate_private_key(), add_client.generate_private_key())
+        self.assertNotEqual(add_client.generate_preshared_key(), add_client.generate_preshared_key())
+
+class WriteSecretTest(unittest.TestCase):
+    def test_writes_with_private_mode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'privatekey')
+            add_client.write_secret(path, 'secret')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'secret')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+class AddPeersUapiTest(unittest.TestCase):
+    PEERS = [
+        (base64.b64encode(b'\x01' * 32).decode(), base64.b64encode(b'\x02' * 32).decode(), '10.8.0.2/32'),
+        (base64.b64encode(b'\x03' * 32).decode(), base64.b64encode(b'\x04' * 32).decode(), '10.8.0.3/32'),
+    ]
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(add_client, 'UAPI_SOCKET_DIR', tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.socket_path = os.path.join(tmp.name, 'awg0.sock')
+        self.request = b""
+
+    def serve(self, response):
+        """Accept one UAPI connection, record the request and send response"""
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(self.socket_path)
+        server.listen(1)
+
+        def handle():
+            conn, _ = server.accept()
+            with conn:
+                while not self.request.endswith(b"\n\n"):
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    self.request += chunk
+                conn.sendall(response)
+
+        thread = threading.Thread(target=handle)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+
+    def test_request_format(self):
+        self.serve(b"errno=0\n\n")
+        self.assertTrue(add_client.add_peers_uapi('awg0', self.PEERS))
+        self.assertEqual(self.request, (
+            b"set=1\n"
+            b"public_key=" + b"01" * 32 + b"\n"
+            b"preshared_key=" + b"02" * 32 + b"\n"
+            b"allowed_ip=10.8.0.2/32\n"
+            b"public_key=" + b"03" * 32 + b"\n"
+            b"preshared_key=" + b"04" * 32 + b"\n"
+            b"allowed_ip=10.8.0.3/32\n"
+            b"\n"
+        ))
+
+    def test_error_response(self):
+        self.serve(b"errno=22\n\n")
+        self.assertFalse(add_client.add_peers_uapi('awg0', self.PEERS))
+
+    def test_missing_socket(self):
+        self.assertFalse(add_client.add_peers_uapi('awg0', self.PEERS))
+
+class AddClientsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.config_dir = tmp.name
+        self.server_config = os.path.join(self.config_dir, 'server.conf')
+        self.clients_dir = os.path.join(self.config_dir, 'clients')
+        os.makedirs(self.clients_dir)
+        with open(self.server_config, 'w') as f:
+            f.write(SERVER_CONF)
+
+        for patcher in (
+            mock.patch.object(add_client, 'CONFIG_DIR', self.config_dir),
+            mock.patch.object(add_client, 'add_peers_uapi', return_value=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+
+    def read_server_conf(self):
+        with open(self.server_config) as f:
+            return f.read()
+
+    def assert_rolled_back(self):
+        self.assertEqual(os.listdir(self.clients_dir), [])
+        self.assertEqual(self.read_server_conf(), SERVER_CONF)
+
+    def test_adds_clients(self):
+        add_client.add_clients(['alice', 'bob'])
+        self.assertEqual(sorted(os.listdir(self.clients_dir)), ['alice', 'bob'])
+        server_conf = self.read_server_conf()
+        self.assertIn("# Client: alice\n", server_conf)
+        self.assertIn("AllowedIPs = 10.8.0.2/32\n", server_conf)
+        self.assertIn("AllowedIPs = 10.8.0.3/32\n", server_conf)
+        with open(os.path.join(self.clients_dir, 'bob', 'bob.conf')) as f:
+            client_conf = f.read()
+        self.assertIn("Address = 10.8.0.3/32\n", client_conf)
+        # Jc comes from server.conf, Jmin falls back to the default
+        self.assertIn("Jc = 7\n", client_conf)
+        self.assertIn("Jmin = 50\n", client_conf)
+
+    def test_rollback_when_server_conf_open_fails(self):
+        real_open = os.open
+
+        def failing_open(path, *args, **kwargs):
+            if path == self.server_config:
+                raise OSError(13, 'Permission denied')
+            return real_open(path, *args, **kwargs)
+
+        with mock.patch.object(add_client.os, 'open', side_effect=failing_open):
+            with self.assertRaises(SystemExit):
+                add_client.add_clients(['alice', 'bob'])
+        self.assert_rolled_back()
+
+    def test_rollback_truncates_partial_append(self):
+        real_write = os.write
+        calls = []
+
+        def short_then_fail(fd, data):
+            # Client files go through fdopen; only the server.conf append uses os.write
+            calls.append(len(data))
+            if len(calls) > 1:
+                raise OSError(28, 'No space left on device')
+            return real_write(fd, bytes(data[:10]))
+
+        with mock.patch.object(add_client.os, 'write', side_effect=short_then_fail):
+            with self.assertRaises(SystemExit):
+                add_client.add_clients(['alice'])
+        self.assertEqual(len(calls), 2)
+        self.assert_rolled_back()
+
+if __name__ == "__main__":
+    unittest.main()